@@ -1,18 +1,23 @@
 import requests
+from requests.adapters import HTTPAdapter
 import os
 import logging
 from argparse import ArgumentParser
 import re
-from bs4 import BeautifulSoup
+import json
+import lxml.html
+from lxml import etree
 from collections import namedtuple
-from peewee import SqliteDatabase, IntegerField, Model
+from concurrent.futures import ThreadPoolExecutor
+from threading import Thread
+from peewee import SqliteDatabase, IntegerField, DateField, DateTimeField, TextField, Model
 import telepot
 from telepot.exception import BotWasBlockedError, BotWasKickedError, TelegramError
 from time import sleep
-from functools import lru_cache
 from datetime import datetime, timedelta
 import pytz
-import schedule
+from apscheduler.schedulers.blocking import BlockingScheduler
+from apscheduler.triggers.cron import CronTrigger
 import dateutil.parser
 import retrying
 from emoji import emojize
@@ -22,16 +27,36 @@ from dotenv import load_dotenv
 load_dotenv()
 log = logging.getLogger('mensabot')
 
-ingredients_re = re.compile(r'[(](\d+[a-z]*,?\s*)+[)]')
+ingredients_re = re.compile(r'[(](?:\d+(?!\d)[a-z]*,?\s*)+[)]')
 price_re = re.compile(r'(\d+),(\d+) €')
 comma_re = re.compile(r'(\w[")]?)\s*,(\w)')
+german_date_re = re.compile(r'^\d{1,2}\.\d{1,2}\.')
+
+meals_wrapper_xpath = etree.XPath(
+    "//div[contains(concat(' ', @class, ' '), ' meals-wrapper ')]"
+)
+meal_items_xpath = etree.XPath(
+    ".//div[contains(concat(' ', @class, ' '), ' meal-item ')]"
+)
+category_xpath = etree.XPath(".//div[contains(@class, 'item category')]//img/@title")
+description_xpath = etree.XPath("string(.//div[contains(@class, 'item description')])")
+supplies_xpath = etree.XPath(".//div[contains(@class, 'item supplies')]//img/@title")
+price_xpath = etree.XPath("string(.//div[contains(@class, $cls)])")
 
 URL = 'https://www.stwdo.de/mensa-co/tu-dortmund/hauptmensa/'
 TZ = pytz.timezone('Europe/Berlin')
+# long enough for a menu prefetched at 11:00 to last through the evening
+MENU_MAX_AGE = timedelta(hours=12)
+SEND_ATTEMPTS = 3
+
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=4))
 
 parser = ArgumentParser()
 parser.add_argument('--database', default='mensabot_clients.sqlite')
 
+german_date_parser = dateutil.parser.parser(dateutil.parser.parserinfo(dayfirst=True))
+
 
 MenuItem = namedtuple(
     'MenuItem',
@@ -59,12 +84,20 @@ class Client(Model):
         database = db
 
 
-class MenuNotFound(Exception):
-    pass
+class CachedMenu(Model):
+    day = DateField(primary_key=True)
+    items = TextField()
+    fetched_at = DateTimeField()
+
+    class Meta:
+        database = db
+
+    def menu(self):
+        return [MenuItem(*item) for item in json.loads(self.items)]
 
 
-def find_item(soup, cls):
-    return soup.find('div', {'class': re.compile('item {}.*'.format(cls))})
+class MenuNotFound(Exception):
+    pass
 
 
 @retrying.retry(
@@ -72,94 +105,144 @@ def find_item(soup, cls):
     wait_fixed=2000,
 )
 def download_menu_page(day):
-    log.info('Downloading menu for day {}'.format(day))
-    ret = requests.get(URL, params={'tx_pamensa_mensa[date]': str(day)})
+    log.info('Downloading menu for day %s', day)
+    ret = session.get(URL, params={'tx_pamensa_mensa[date]': str(day)})
     ret.raise_for_status()
     log.info('Done')
-    return BeautifulSoup(ret.text, 'lxml')
+    return lxml.html.fromstring(ret.content)
 
 
-def extract_menu_items(soup):
+def extract_menu_items(tree):
 
-    menu_div = soup.find('div', {'class': 'meals-wrapper'})
+    menu_divs = meals_wrapper_xpath(tree)
 
-    if menu_div is None:
+    if len(menu_divs) == 0:
         raise MenuNotFound
 
-    menu_items = menu_div.find_all('div', {'class': 'meal-item'})
+    menu_items = meal_items_xpath(menu_divs[0])
 
     return list(map(parse_menu_item, menu_items))
 
 
-def parse_price(price_div):
-    m = price_re.search(price_div.text)
+def parse_price(menu_item, cls):
+    m = price_re.search(price_xpath(menu_item, cls='item price {}'.format(cls)))
     euros, cents = map(int, m.groups())
     return euros + cents / 100
 
 
 def parse_menu_item(menu_item):
-    category_item = find_item(menu_item, 'category').find('img')
-    if category_item is not None:
-        category = category_item['title']
-    else:
-        category = ''
+    categories = category_xpath(menu_item)
+    category = str(categories[0]) if categories else ''
 
-    description = find_item(menu_item, 'description').text.lstrip()
+    description = description_xpath(menu_item).lstrip()
     description = ingredients_re.sub('', description)
     description = comma_re.sub(r'\1, \2', description)
 
-    supplies = [
-        img.get('title', '')
-        for img in find_item(menu_item, 'supplies').find_all('img')
-    ]
+    supplies = [str(title) for title in supplies_xpath(menu_item)]
     emoticons = ''.join(supplies_emoticons.get(s, '') for s in supplies)
 
-    p_student = parse_price(find_item(menu_item, 'price student'))
-    p_staff = parse_price(find_item(menu_item, 'price staff'))
-    p_guest = parse_price(find_item(menu_item, 'price guest'))
+    p_student = parse_price(menu_item, 'student')
+    p_staff = parse_price(menu_item, 'staff')
+    p_guest = parse_price(menu_item, 'guest')
 
     return MenuItem(category, description, supplies, emoticons, p_student, p_staff, p_guest)
 
 
-@lru_cache(maxsize=10)
-def get_menu(day):
-    soup = download_menu_page(day)
-    items = extract_menu_items(soup)
+def local_now():
+    """Current time in TZ as naive datetime, the way it is stored in the database"""
+    return datetime.now(TZ).replace(tzinfo=None)
+
+
+def get_menu(day, fetched_after=None):
+    """
+    Get the menu for a date, datetime or ISO date string from the database
+    if fetched after fetched_after (default: MENU_MAX_AGE ago), else download
+    and store it. If the download fails, an older stored menu is used.
+    """
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day)
+    if isinstance(day, datetime):
+        day = day.date()
+
+    if fetched_after is None:
+        fetched_after = local_now() - MENU_MAX_AGE
+
+    cached = CachedMenu.get_or_none(CachedMenu.day == day)
+    if cached is not None and cached.fetched_at > fetched_after:
+        return cached.menu()
+
+    try:
+        tree = download_menu_page(day)
+        items = extract_menu_items(tree)
+    except Exception:
+        if cached is None:
+            raise
+        log.exception('Error downloading menu for %s, using menu from %s', day, cached.fetched_at)
+        return cached.menu()
+
+    # the menu is not always online in advance, only store complete ones
+    if len(items) > 0:
+        CachedMenu.replace(
+            day=day, items=json.dumps(items), fetched_at=local_now()
+        ).execute()
+
     return items
 
 
+def prefetch_menu(day):
+    """Store the menu of day in the database"""
+    try:
+        get_menu(day)
+    except MenuNotFound:
+        log.info('Menu for %s not yet online, not prefetching', day)
+    except Exception:
+        log.exception('Error prefetching menu for %s', day)
+
+
 def format_menu(menu, full=False, date=None):
 
 
     if full is False:
         menu = filter(lambda i: i.category not in ('Grillstation', 'Beilagen'), menu)
 
-    title = '*Hauptmensa*'
     if date is not None:
-        title += ' ({:%d.%m.%Y})'.format(date)
+        parts = [f'*Hauptmensa* ({date:%d.%m.%Y})']
+    else:
+        parts = ['*Hauptmensa*']
 
     last_category = ''
-
-    items = []
     for item in menu:
         category = item.category or last_category
         last_category = item.category
-        items.append(
-            '*{category}* - {item.emoticons}\n{item.description}'.format(
-                category=category, item=item
-            )
-        )
+        parts.append(f'*{category}* - {item.emoticons}\n{item.description}')
+
+    return '\n\n'.join(parts)
+
+
+def parse_date(datestring):
+    """Parse a date argument, reading German dates like 05.01.2024 day first"""
+    try:
+        return datetime.fromisoformat(datestring)
+    except ValueError:
+        pass
 
-    return title + '\n\n' + '\n\n'.join(items)
+    if german_date_re.match(datestring):
+        return german_date_parser.parse(datestring)
+    return dateutil.parser.parse(datestring)
 
 
 def build_menu_reply(text):
     full = text.startswith('/fullmenu')
 
-    try:
-        datestring = text.split()[1]
-        dt = dateutil.parser.parse(datestring)
-    except (ValueError, IndexError):
+    dt = None
+    args = text.split(maxsplit=2)[1:]
+    if len(args) > 0:
+        try:
+            dt = parse_date(args[0])
+        except (ValueError, OverflowError):
+            pass
+
+    if dt is None:
         dt = datetime.now(TZ)
         if dt.hour >= 15:
             dt += timedelta(days=1)
@@ -182,21 +265,21 @@ def build_menu_reply(text):
         return 'Fehler beim formatieren von Tag {}'.format(day)
 
 
-def create_message(day):
+def create_message(day, fetched_after=None):
     try:
-        menu = get_menu(day)
+        menu = get_menu(day, fetched_after=fetched_after)
     except Exception:
         log.error('Error getting menu')
         return 'Fehler beim herunterladen des Menüs für {}'.format(day)
 
     if len(menu) == 0:
-        log.error('Empty menu {}'.format(menu))
+        log.error('Empty menu %s', menu)
         return 'Leeres Menü für {}'.format(day)
 
     try:
         return format_menu(menu, date=day)
     except Exception as e:
-        logging.exception('Error formatting menu')
+        log.exception('Error formatting menu')
         return 'Fehler beim formatieren des Menüs für {}'.format(day)
 
 
@@ -237,7 +320,7 @@ class MensaBot(telepot.Bot):
         else:
             reply = 'Das habe ich nicht verstanden'
 
-        log.info('Sending message to {}'.format(chat_id))
+        log.info('Sending message to %s', chat_id)
         self.sendMessage(chat_id, reply, parse_mode='markdown')
 
     def send_menu_to_clients(self):
@@ -246,20 +329,49 @@ class MensaBot(telepot.Bot):
         if day.weekday() >= 5:
             return
 
-        text = create_message(day)
-        for client in Client.select():
-            log.info('Sending menu to {}'.format(client.chat_id))
-            try:
-                self.sendMessage(client.chat_id, text, parse_mode='markdown')
-            except (BotWasBlockedError, BotWasKickedError):
-                log.warning('Removing client {}'.format(client.chat_id))
-                client.delete_instance()
-            except TelegramError as e:
-                if e.error_code == 403:
-                    log.warning('Removing client {}'.format(client.chat_id))
-                    client.delete_instance()
-            except Exception as e:
-                logging.exception('Error sending message to client {}'.format(client.chat_id))
+        # do not send a snapshot prefetched yesterday, only menus fetched today
+        text = create_message(day, fetched_after=datetime.combine(day, datetime.min.time()))
+
+        def send_menu(client):
+            """Send the menu to client, return False if the client is gone"""
+            log.info('Sending menu to %s', client.chat_id)
+            for attempt in range(SEND_ATTEMPTS):
+                try:
+                    self.sendMessage(client.chat_id, text, parse_mode='markdown')
+                    return True
+                except (BotWasBlockedError, BotWasKickedError):
+                    return False
+                except TelegramError as e:
+                    if e.error_code == 403:
+                        return False
+                    if e.error_code == 429 and attempt < SEND_ATTEMPTS - 1:
+                        retry_after = e.json.get('parameters', {}).get('retry_after', 1)
+                        log.warning(
+                            'Rate limited sending to client %s, retrying in %s s',
+                            client.chat_id, retry_after,
+                        )
+                        sleep(retry_after)
+                        continue
+                    log.error('Error sending message to client %s: %s', client.chat_id, e)
+                    return True
+                except Exception:
+                    log.exception('Error sending message to client %s', client.chat_id)
+                    return True
+
+        clients = list(Client.select())
+        with ThreadPoolExecutor(max_workers=4) as executor:
+            reachable = list(executor.map(send_menu, clients))
+
+        dead = [client.chat_id for client, ok in zip(clients, reachable) if not ok]
+        if len(dead) > 0:
+            log.warning('Removing clients %s', dead)
+            with db.atomic():
+                Client.delete().where(Client.chat_id.in_(dead)).execute()
+
+        # after 15:00 /menu shows tomorrow's menu, have it ready by then
+        tomorrow = day + timedelta(days=1)
+        if tomorrow.weekday() < 5:
+            Thread(target=prefetch_menu, args=(tomorrow,), daemon=True).start()
 
 
 def main():
@@ -278,24 +390,30 @@ def main():
     file_handler.setFormatter(formatter)
     log.addHandler(file_handler)
 
+    # exceptions raised by scheduled jobs are logged by apscheduler
+    scheduler_log = logging.getLogger('apscheduler')
+    scheduler_log.addHandler(stream_handler)
+    scheduler_log.addHandler(file_handler)
+
     db.init(args.database)
     Client.create_table(safe=True)
+    CachedMenu.create_table(safe=True)
 
-    log.info("Using database {}".format(os.path.abspath(args.database)))
-    log.info("Database contains {} active clients".format(Client.select().count()))
+    log.info("Using database %s", os.path.abspath(args.database))
+    log.info("Database contains %s active clients", Client.select().count())
 
     bot = MensaBot(os.environ['BOT_TOKEN'])
     bot.message_loop()
     log.info('Bot runnning')
 
-    schedule.every().day.at('11:00').do(bot.send_menu_to_clients)
-
-    while True:
-        try:
-            schedule.run_pending()
-        except:
-            log.exception('Exception during schedule execution')
-        sleep(1)
+    scheduler = BlockingScheduler(timezone=TZ)
+    scheduler.add_job(
+        bot.send_menu_to_clients,
+        CronTrigger(hour=11, minute=0, timezone=TZ),
+        misfire_grace_time=3600,
+        coalesce=True,
+    )
+    scheduler.start()
 
 
 if __name__ == '__main__':